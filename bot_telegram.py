@@ -1,13 +1,12 @@
 import asyncio
 import logging
-import json
 import os
-import re
 from pathlib import Path
-from typing import Dict, Any
-from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta
 
 import httpx
+import orjson
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -24,6 +23,11 @@ from telegram.ext import (
 # with the provided token as a fallback for local testing.
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '7748825401:AAEYddmh_OTNXkBgzAyfCuduMEoI7nmyNQs')
 STATS_FILE = Path('reference_stats.json')
+# How often (in seconds) pending stats changes are written back to disk.
+STATS_FLUSH_INTERVAL = 2.0
+# Number of days of per-day counts kept for each site, today included; older
+# days are dropped.
+STATS_RETENTION_DAYS = 90
 
 # Define your API endpoints and secret keys here.
 ENDPOINTS = {
@@ -44,6 +48,16 @@ UPDATE_BUTTON_TEXT = "🚀 Add Reference"
 STATS_BUTTON_TEXT = "📊 View Stats"
 BACK_TO_MENU_TEXT = "⬅️ Back to Main Menu"
 
+# Keyboards never change at runtime, so they are built once and shared.
+# Main menu keyboard layout
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup(
+    [[UPDATE_BUTTON_TEXT, STATS_BUTTON_TEXT]], resize_keyboard=True, one_time_keyboard=False
+)
+# Website selection keyboard, one button per entry in ENDPOINTS.
+SELECT_SITE_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(site_name, callback_data=site_name)] for site_name in ENDPOINTS]
+)
+
 # --- LOGGING SETUP ---
 # Configure logging to provide timestamps and clear information for debugging.
 logging.basicConfig(
@@ -55,49 +69,167 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# --- DATE HELPERS ---
+# The current date string and the stats retention cutoff are cached and only
+# rebuilt when the day rolls over.
+_TODAY: Dict[str, Any] = {'date': None, 'str': '', 'cutoff': ''}
+
+def today_str() -> str:
+    """Returns today's date as 'YYYY-MM-DD', formatting it at most once per day."""
+    today = datetime.now().date()
+    if today != _TODAY['date']:
+        _TODAY['date'] = today
+        _TODAY['str'] = today.isoformat()
+        _TODAY['cutoff'] = (today - timedelta(days=STATS_RETENTION_DAYS - 1)).isoformat()
+    return _TODAY['str']
+
+def retention_cutoff_str() -> str:
+    """Returns the oldest 'YYYY-MM-DD' date whose daily counts are still kept."""
+    today_str()
+    return _TODAY['cutoff']
+
+
 # --- STATS HANDLING ---
-# Functions to asynchronously load and save statistics.
-async def load_stats() -> Dict[str, Any]:
-    """Asynchronously loads 'reference' counts from the JSON stats file."""
+# Stats are loaded from disk once at startup and kept in memory. Handlers only
+# mark the cache dirty; a background task writes it back every
+# STATS_FLUSH_INTERVAL seconds and once more on shutdown. The lock serializes
+# access between handlers and the flush task.
+STATS_CACHE: Dict[str, Any] = {}
+_stats_lock = asyncio.Lock()
+_stats_dirty = False
+_stats_flush_task: Optional[asyncio.Task] = None
+# Set on shutdown to make the writeback task do its final flush and exit.
+_stats_stop = asyncio.Event()
+# Revision counter bumped on every stats change, and the last rendered stats
+# message keyed by (revision, date) so repeated requests reuse it.
+_stats_rev = 0
+_stats_text_cache: Dict[str, Any] = {'rev': 0, 'date': None, 'text': ''}
+# Rendered per-site stats lines keyed by (name, total, today_count); cleared
+# once it grows past _LINE_CACHE_MAX entries.
+_LINE_CACHE: Dict[Tuple[str, int, int], str] = {}
+_LINE_CACHE_MAX = 1024
+
+# Functions to load and save statistics. The blocking file I/O runs in a worker
+# thread so the event loop keeps dispatching updates meanwhile.
+def _load_stats_sync() -> Dict[str, Any]:
+    """Reads 'reference' counts from the JSON stats file (blocking)."""
     if STATS_FILE.is_file():
         try:
-            with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                stats = json.load(f)
-                # Ensure all configured endpoints are present in the stats file.
-                for site in ENDPOINTS:
-                    if site not in stats:
-                        stats[site] = {'total': 0, 'daily': {}}
-                    elif isinstance(stats[site], int):
-                        # Convert old format to new format
-                        old_total = stats[site]
-                        stats[site] = {'total': old_total, 'daily': {}}
-                return stats
-        except (json.JSONDecodeError, IOError) as e:
-            logger.error(f"Error reading stats file: {e}")
+            stats = orjson.loads(STATS_FILE.read_bytes())
+            # Ensure all configured endpoints are present in the stats file.
+            for site in ENDPOINTS:
+                if site not in stats:
+                    stats[site] = {'total': 0, 'daily': {}}
+                elif isinstance(stats[site], int):
+                    # Convert old format to new format
+                    old_total = stats[site]
+                    stats[site] = {'total': old_total, 'daily': {}}
+            return stats
+        except (orjson.JSONDecodeError, IOError) as e:
+            logger.error("Error reading stats file: %s", e)
             # Return a zeroed stats dict if the file is corrupt or unreadable.
             return {site: {'total': 0, 'daily': {}} for site in ENDPOINTS}
     # Return a zeroed stats dict if the file doesn't exist.
     return {site: {'total': 0, 'daily': {}} for site in ENDPOINTS}
 
-async def save_stats(stats: Dict[str, Any]) -> None:
-    """Asynchronously saves 'reference' counts to the JSON stats file."""
+def _write_stats_sync(data: bytes) -> bool:
+    """Writes already serialized stats to the JSON stats file (blocking).
+
+    The data goes to a temporary file that then replaces the stats file, so a
+    crash mid-write never leaves a truncated file behind. Returns False if the
+    write failed.
+    """
+    tmp_file = STATS_FILE.with_name(STATS_FILE.name + '.tmp')
     try:
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stats, f, indent=4)
-    except IOError as e:
-        logger.error(f"Error writing to stats file: {e}")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, STATS_FILE)
+        return True
+    except OSError as e:
+        logger.error("Error writing to stats file: %s", e)
+        return False
+
+def _prune_daily(daily: Dict[str, int]) -> Dict[str, int]:
+    """Drops daily counts older than the retention window so the stats file stays bounded."""
+    # ISO dates compare correctly as strings.
+    cutoff = retention_cutoff_str()
+    return {day: count for day, count in daily.items() if day >= cutoff}
+
+async def load_stats() -> Dict[str, Any]:
+    """Asynchronously loads 'reference' counts from the JSON stats file."""
+    return await asyncio.to_thread(_load_stats_sync)
+
+async def flush_stats() -> None:
+    """Writes the stats cache to disk if it changed since the last flush."""
+    global _stats_dirty
+    # Serialize under the lock so the worker thread gets a consistent snapshot,
+    # then write outside it so handlers don't wait on the disk.
+    async with _stats_lock:
+        if not _stats_dirty:
+            return
+        _stats_dirty = False
+        data = orjson.dumps(STATS_CACHE, option=orjson.OPT_INDENT_2)
+    if not await asyncio.to_thread(_write_stats_sync, data):
+        # Keep the changes pending so the next flush retries them.
+        _stats_dirty = True
+
+async def _flush_stats_periodically() -> None:
+    """Background loop that flushes pending stats changes at a fixed interval.
+
+    This task is the only writer of the stats file, so writes never overlap.
+    Once _stats_stop is set it performs a final flush and returns.
+    """
+    while not _stats_stop.is_set():
+        try:
+            await asyncio.wait_for(_stats_stop.wait(), timeout=STATS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await flush_stats()
+
+async def post_init(application: Application) -> None:
+    """Loads the stats cache, starts the writeback task and opens the shared HTTP client."""
+    global _stats_dirty, _stats_flush_task
+    # One client for the bot's lifetime so connections to the endpoints are
+    # kept alive and reused instead of doing a new TCP+TLS handshake each time.
+    # Created first: it raises ImportError without the h2 package, and startup
+    # should fail before any background task is running.
+    application.bot_data['http_client'] = httpx.AsyncClient(
+        timeout=15.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        http2=True,
+    )
+    async with _stats_lock:
+        STATS_CACHE.update(await load_stats())
+        # Prune once at startup so days from the file don't linger until the
+        # site gets new traffic.
+        for site_stats in STATS_CACHE.values():
+            daily = _prune_daily(site_stats['daily'])
+            if len(daily) != len(site_stats['daily']):
+                site_stats['daily'] = daily
+                _stats_dirty = True
+    _stats_flush_task = asyncio.create_task(_flush_stats_periodically())
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the writeback task, flushes pending stats and closes the HTTP client."""
+    # Ask the task to stop instead of cancelling it: a cancelled task would
+    # leave its worker thread writing while a second flush starts here.
+    _stats_stop.set()
+    if _stats_flush_task is not None:
+        try:
+            await _stats_flush_task
+        except Exception:
+            logger.exception("Stats writeback task failed:")
+    # The task has finished by now, so this cannot overlap with its writes. It
+    # is a no-op after a clean final flush and a fallback if the task failed.
+    await flush_stats()
+    http_client = application.bot_data.pop('http_client', None)
+    if http_client is not None:
+        await http_client.aclose()
 
 
 # --- CORE UI FUNCTIONS ---
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = None) -> None:
     """Displays the main menu keyboard along with a message."""
-    # Main menu keyboard layout
-    reply_keyboard = [[UPDATE_BUTTON_TEXT, STATS_BUTTON_TEXT]]
-    main_menu_markup = ReplyKeyboardMarkup(
-        reply_keyboard, resize_keyboard=True, one_time_keyboard=False
-    )
-
     # Use a default welcome message if none is provided.
     if message_text is None:
         user = update.effective_user
@@ -106,14 +238,14 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
     if update.message:
         await update.message.reply_text(
             text=message_text,
-            reply_markup=main_menu_markup,
+            reply_markup=MAIN_MENU_MARKUP,
             parse_mode='Markdown'
         )
     elif update.callback_query:
          await context.bot.send_message(
             chat_id=update.callback_query.message.chat_id,
             text=message_text,
-            reply_markup=main_menu_markup,
+            reply_markup=MAIN_MENU_MARKUP,
             parse_mode='Markdown'
         )
 
@@ -123,24 +255,17 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command. Greets the user and shows the main menu."""
     user = update.effective_user
-    logger.info(f"User {user.full_name} ({user.id}) started the bot.")
+    logger.info("User %s (%s) started the bot.", user.full_name, user.id)
     await show_main_menu(update, context)
 
 async def select_website_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Prompts the user to select a website to update."""
-    # Create a dynamic keyboard from the ENDPOINTS dictionary.
-    keyboard = [
-        [InlineKeyboardButton(site_name, callback_data=site_name)]
-        for site_name in ENDPOINTS.keys()
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     # Clear any previous selection to avoid sending to the wrong target.
     context.user_data['referencia_target'] = None
 
     await update.message.reply_text(
         "Please choose which website you want to send the reference to:",
-        reply_markup=reply_markup
+        reply_markup=SELECT_SITE_MARKUP
     )
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -148,11 +273,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()  # Acknowledge the button press to remove the loading icon.
 
+    ud = context.user_data
     choice = query.data
-    context.user_data['referencia_target'] = choice
+    ud['referencia_target'] = choice
     user = update.effective_user
 
-    logger.info(f"User {user.full_name} ({user.id}) selected '{choice}'.")
+    logger.info("User %s (%s) selected '%s'.", user.full_name, user.id, choice)
 
     await query.edit_message_text(
         text=(
@@ -165,10 +291,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def referencia_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles incoming text messages to process them as reference numbers."""
-    target_site = context.user_data.get('referencia_target')
-    user = update.effective_user
+    global _stats_dirty, _stats_rev
+    ud = context.user_data
+    target_site = ud.get('referencia_target')
+    # A single lookup both validates the target and fetches its config.
+    endpoint_config = ENDPOINTS.get(target_site) if target_site else None
 
-    if not target_site:
+    if not endpoint_config:
         await update.message.reply_text(
             f"Please select a website first by clicking the '{UPDATE_BUTTON_TEXT}' button."
         )
@@ -176,10 +305,10 @@ async def referencia_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     raw_text = update.message.text
     # Sanitize the input by removing spaces.
-    referencia_number = re.sub(r'\s+', '', raw_text)
+    referencia_number = ''.join(raw_text.split())
 
     # Validate that the number is exactly 9 digits.
-    if not re.fullmatch(r'\d{9}', referencia_number):
+    if len(referencia_number) != 9 or not referencia_number.isdecimal():
         await update.message.reply_text(
             "❌ **Invalid Format**\n"
             "The reference number must be exactly 9 digits. "
@@ -188,53 +317,81 @@ async def referencia_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    logger.info(f"Processing reference {referencia_number} for '{target_site}' from user {user.full_name}.")
+    # Take the target out before the first await. With concurrent updates, a
+    # second message from the same user then gets the 'select a website
+    # first' prompt instead of being sent too, and a site picked while this
+    # request is in flight is left alone.
+    ud.pop('referencia_target', None)
+
+    logger.info(
+        "Processing reference %s for '%s' from user %s.",
+        referencia_number, target_site, update.effective_user.full_name
+    )
     processing_message = await update.message.reply_text("⏳ Processing, please wait...")
 
-    endpoint_config = ENDPOINTS[target_site]
+    endpoint_url = endpoint_config['url']
+    endpoint_key = endpoint_config['key']
     # **FIXED**: The parameter sent to the server is now 'invoice' as required by the PHP script.
-    params = {'invoice': referencia_number, 'key': endpoint_config['key']}
+    params = {'invoice': referencia_number, 'key': endpoint_key}
     final_message = ""
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                endpoint_config['url'], params=params, timeout=15.0
-            )
+        client: httpx.AsyncClient = context.bot_data['http_client']
+        # Stream the response so a successful body is never buffered or decoded;
+        # only error bodies are read, since they are shown to the user.
+        async with client.stream('GET', endpoint_url, params=params) as response:
+            if response.is_success:
+                # Drain the body so the connection can go back to the pool.
+                async for _ in response.aiter_raw():
+                    pass
+            else:
+                await response.aread()
             response.raise_for_status() # Raise an exception for 4xx or 5xx status codes.
 
-        stats = await load_stats()
-        today_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # Update total count
-        stats[target_site]['total'] += 1
-        
-        # Update daily count
-        if today_date not in stats[target_site]['daily']:
-            stats[target_site]['daily'][today_date] = 0
-        stats[target_site]['daily'][today_date] += 1
-        
-        await save_stats(stats)
-
-        logger.info(f"Successfully updated reference {referencia_number} for '{target_site}'.")
+        today_date = today_str()
+
+        async with _stats_lock:
+            stats = STATS_CACHE
+
+            # Update total count
+            stats[target_site]['total'] += 1
+
+            # Update daily count
+            if today_date not in stats[target_site]['daily']:
+                stats[target_site]['daily'][today_date] = 0
+            stats[target_site]['daily'][today_date] += 1
+
+            stats[target_site]['daily'] = _prune_daily(stats[target_site]['daily'])
+
+            _stats_dirty = True
+            _stats_rev += 1
+
+            # Copy the counts while the lock is held so the message below
+            # cannot pick up another request's update.
+            total = stats[target_site]['total']
+            today_count = stats[target_site]['daily'][today_date]
+
+        logger.info("Successfully updated reference %s for '%s'.", referencia_number, target_site)
         final_message = (
             f"✅ The reference **{referencia_number}** has been successfully updated on **{target_site}**.\n\n"
-            f"🧾 Total references sent to this site: **{stats[target_site]['total']}**\n"
-            f"📅 Total references today: **{stats[target_site]['daily'][today_date]}**"
+            f"🧾 Total references sent to this site: **{total}**\n"
+            f"📅 Total references today: **{today_count}**"
         )
         await processing_message.edit_text(final_message, parse_mode='Markdown')
 
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error for reference {referencia_number}: {e.response.status_code} - {e.response.text}")
+        status_code = e.response.status_code
+        error_body = e.response.text
+        logger.error("HTTP error for reference %s: %s - %s", referencia_number, status_code, error_body)
         final_message = (
             f"⚠️ **Server Error**\n"
-            f"The server for '{target_site}' responded with an error: `{e.response.status_code}`.\n"
-            f"Details: `{e.response.text}`"
+            f"The server for '{target_site}' responded with an error: `{status_code}`.\n"
+            f"Details: `{error_body}`"
         )
         await processing_message.edit_text(final_message, parse_mode='Markdown')
 
     except httpx.RequestError as e:
-        logger.error(f"Request failed for reference {referencia_number}: {e}")
+        logger.error("Request failed for reference %s: %s", referencia_number, e)
         final_message = (
             f"❌ **Connection Failed**\n"
             f"Could not connect to the server for '{target_site}'. Please try again later."
@@ -242,35 +399,45 @@ async def referencia_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await processing_message.edit_text(final_message)
 
     except Exception as e:
-        logger.exception(f"An unexpected error occurred while processing reference {referencia_number}:")
+        logger.exception("An unexpected error occurred while processing reference %s:", referencia_number)
         final_message = (
             f"❌ **An Unexpected Error Occurred**\n"
             f"Something went wrong. The error was: `{str(e)}`"
         )
         await processing_message.edit_text(final_message)
     finally:
-        # Automatically return the user to the main menu after a short delay.
-        await asyncio.sleep(1.5)
-        context.user_data['referencia_target'] = None # Clear target
+        # Automatically return the user to the main menu.
         await show_main_menu(update, context, message_text="You can add another reference or view the stats.")
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /stats command and button to show total references sent."""
-    stats = await load_stats()
-    user = update.effective_user
-    logger.info(f"User {user.full_name} requested stats.")
-    
-    today_date = datetime.now().strftime('%Y-%m-%d')
+    logger.info("User %s requested stats.", update.effective_user.full_name)
+
+    today_date = today_str()
 
-    if not any(stats[site]['total'] for site in stats):
+    async with _stats_lock:
+        stats = STATS_CACHE
+        stats_rev = _stats_rev
+
+    # Reuse the last rendered message if no reference was added since and the day is the same.
+    if (stats_rev, today_date) == (_stats_text_cache['rev'], _stats_text_cache['date']):
+        message_text = _stats_text_cache['text']
+    elif not any(stats[site]['total'] for site in stats):
         message_text = "📊 **Reference Stats:**\n\nNo references have been sent yet."
     else:
         stats_lines = []
         for name, site_stats in stats.items():
             today_count = site_stats['daily'].get(today_date, 0)
-            stats_lines.append(f"• **{name}**: {site_stats['total']} total, {today_count} today")
+            key = (name, site_stats['total'], today_count)
+            line = _LINE_CACHE.get(key)
+            if line is None:
+                if len(_LINE_CACHE) >= _LINE_CACHE_MAX:
+                    _LINE_CACHE.clear()
+                line = _LINE_CACHE[key] = f"• **{name}**: {site_stats['total']} total, {today_count} today"
+            stats_lines.append(line)
         message_text = "📊 **Reference Stats:**\n\n" + "\n".join(stats_lines)
+    _stats_text_cache.update(rev=stats_rev, date=today_date, text=message_text)
 
     await update.message.reply_text(message_text, parse_mode='Markdown')
 
@@ -281,15 +448,25 @@ def main() -> None:
         logger.error("Telegram token is not configured. Please set it in the script or as an environment variable.")
         return
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Updates are processed concurrently so one user's slow HTTP round-trip does
+    # not hold up everyone else; shared stats state is guarded by _stats_lock.
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    # Regex to match the main menu buttons exactly, preventing the text handler from catching them.
-    button_filter = filters.Regex(f"^({UPDATE_BUTTON_TEXT}|{STATS_BUTTON_TEXT})$")
+    # Exact text match for the main menu buttons, preventing the text handler from catching them.
+    # filters.Text compares strings directly, so no regex runs on incoming messages.
+    button_filter = filters.Text((UPDATE_BUTTON_TEXT, STATS_BUTTON_TEXT))
 
     # Add handlers for different commands and messages.
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(MessageHandler(filters.Regex(f"^{STATS_BUTTON_TEXT}$"), stats_command))
-    application.add_handler(MessageHandler(filters.Regex(f"^{UPDATE_BUTTON_TEXT}$"), select_website_prompt))
+    application.add_handler(MessageHandler(filters.Text((STATS_BUTTON_TEXT,)), stats_command))
+    application.add_handler(MessageHandler(filters.Text((UPDATE_BUTTON_TEXT,)), select_website_prompt))
     application.add_handler(CallbackQueryHandler(button_handler))
     # The 'referencia_handler' now ignores commands and the main menu buttons.
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~button_filter, referencia_handler))